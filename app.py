@@ -1,67 +1,575 @@
 # app.py (UPDATED: JSON-first MCQ generation with robust parsing & fallbacks)
 from dotenv import load_dotenv
+import glob
+import io
+import multiprocessing
 import os
-import json
-import re
+import tempfile
+import orjson
 import time
-from flask import Flask, render_template, request, send_file
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, render_template, request, send_file, stream_template
 import pdfplumber
-import docx
-from werkzeug.utils import secure_filename
+import pypdfium2 as pdfium
+import zipfile
+from lxml import etree
+from werkzeug.utils import safe_join, secure_filename
 from fpdf import FPDF
+from fpdf.enums import XPos, YPos
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from pdf_worker import extract_pdf_pages
 
 load_dotenv()  # load env vars from .env
 
 API_KEY = os.getenv("API_KEY")
+MODEL = "sonar-reasoning-pro"
+CHUNK_CHARS = 6000  # ~1500 tokens of source text per API call
+MAX_PROMPT_CHUNKS = 8  # caps source text sent per generation at ~12k tokens
+PARALLEL_PDF_MIN_PAGES = 4  # below this, process startup costs more than it saves
+
+# WordprocessingML tags for paragraphs, text runs, tabs, breaks and text boxes in word/document.xml
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = _W_NS + "p"
+_W_R = _W_NS + "r"
+_W_T = _W_NS + "t"
+_W_TAB = _W_NS + "tab"
+_W_BR = _W_NS + "br"
+_W_CR = _W_NS + "cr"
+_W_TYPE = _W_NS + "type"
+_W_TXBX = _W_NS + "txbxContent"
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads/'
 app.config['RESULTS_FOLDER'] = 'results/'
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'txt', 'docx'}
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max upload (optional)
+app.config['MAX_PDF_PAGES'] = 300  # cap pathological documents
+app.config['CACHE_PATH'] = os.getenv("MCQ_CACHE_PATH", "mcq_cache.sqlite3")
+app.config['CACHE_TTL'] = int(os.getenv("MCQ_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+
+
+class LLMCache:
+    """
+    Small SQLite-backed cache for validated MCQ lists.
+    Keys are SHA-256 digests over (model, normalized text, num_questions), so
+    re-uploads of the same document (even with different whitespace) skip the API.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        try:
+            with self._connect() as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS mcq_cache ("
+                    "key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)"
+                )
+        except sqlite3.Error as e:
+            # The app still works without the cache; every lookup just misses
+            app.logger.warning("MCQ cache unavailable at %s: %s", path, e)
+
+    def _connect(self):
+        # closing(): sqlite3's own context manager only commits, it never closes
+        return closing(sqlite3.connect(self.path, timeout=5))
+
+    @staticmethod
+    def make_key(model, text, num_questions):
+        normalized = ' '.join(text.split())
+        h = hashlib.sha256()
+        for part in (model, str(num_questions), normalized):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the cached MCQ list, or None on a miss, an expired entry or a cache error."""
+        value = None
+        try:
+            with self._lock, self._connect() as conn, conn:
+                row = conn.execute(
+                    "SELECT value, created FROM mcq_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if time.time() - row[1] > self.ttl:
+                        conn.execute("DELETE FROM mcq_cache WHERE key = ?", (key,))
+                    else:
+                        value = row[0]
+        except sqlite3.Error as e:
+            app.logger.warning("MCQ cache lookup failed, treating as a miss: %s", e)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        app.logger.debug("MCQ cache %s (hits=%d, misses=%d)",
+                         "miss" if value is None else "hit", self.hits, self.misses)
+        return None if value is None else orjson.loads(value)
+
+    def set(self, key, mcqs):
+        try:
+            with self._lock, self._connect() as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO mcq_cache (key, value, created) VALUES (?, ?, ?)",
+                    (key, orjson.dumps(mcqs), time.time())
+                )
+        except sqlite3.Error as e:
+            app.logger.warning("MCQ cache write failed: %s", e)
+
+
+# Extracted document text, keyed by content hash (see extract_text_from_file),
+# bounded both by entry count and by total characters held
+TEXT_CACHE_SIZE = 128
+TEXT_CACHE_MAX_CHARS = 32 * 1024 * 1024
+_text_cache = OrderedDict()
+_text_cache_chars = 0
+_text_cache_lock = threading.Lock()
+
+# Created at import time so they also exist under gunicorn, not just `python app.py`
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
+
+llm_cache = LLMCache(app.config['CACHE_PATH'], app.config['CACHE_TTL'])
+# Shared HTTP session: keeps TLS connections to the API alive across requests
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+))
+# Caps in-flight Perplexity calls across all requests handled by this process,
+# whether they run on _api_executor or directly on a request thread
+MAX_CONCURRENT_API_CALLS = 8
+_api_slots = threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+# Runs the chunk calls of a single generation concurrently
+_api_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_API_CALLS)
+# pdfium is not thread-safe: calls made in this process are serialized, and
+# parallel extraction runs in worker processes (see _get_pdf_executor)
+_pdfium_lock = threading.Lock()
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+# TXT/PDF exports are written in the background. Each one keeps its own
+# "<name>.<random>.pending" marker on disk while it runs, so any gunicorn worker can
+# tell whether a download is ready; markers older than EXPORT_TIMEOUT seconds
+# (e.g. left behind by a killed worker) are ignored.
+_export_executor = ThreadPoolExecutor(max_workers=4)
+EXPORT_TIMEOUT = 120
+PENDING_SUFFIX = ".pending"
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
-def extract_text_from_file(file_path):
+def _get_pdf_executor():
+    """
+    Return the PDF worker-process pool, creating it on first use rather than at import,
+    so processes that merely import this module don't start one. forkserver avoids
+    forking a process that already has executor threads running; where it isn't
+    available (Windows), spawn is used. Workers only need the side-effect-free
+    pdf_worker module, which the fork server preloads.
+    """
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload(["pdf_worker"])
+            else:
+                ctx = multiprocessing.get_context("spawn")
+            _pdf_executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=ctx)
+        return _pdf_executor
+
+
+def _pdf_page_ranges(file_path):
+    """
+    Split a PDF's pages (capped at MAX_PDF_PAGES) into contiguous [start, stop) ranges,
+    one per core, or a single range for short documents.
+    """
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            n_pages = min(len(pdf), app.config['MAX_PDF_PAGES'])
+        finally:
+            pdf.close()
+    if n_pages == 0:
+        return []
+
+    parts = min(os.cpu_count() or 1, n_pages)
+    if n_pages <= PARALLEL_PDF_MIN_PAGES or parts < 2:
+        return [(0, n_pages)]
+    step = -(-n_pages // parts)  # ceil division
+    return [(start, min(start + step, n_pages)) for start in range(0, n_pages, step)]
+
+
+def iter_pdf_text(file_path, ranges):
+    """
+    Yield the text of each page range, in order, as soon as it is extracted.
+    Multiple ranges are extracted in parallel on the shared worker-process pool.
+    """
+    if len(ranges) <= 1:
+        for start, stop in ranges:
+            with _pdfium_lock:
+                text = extract_pdf_pages(file_path, start, stop)
+            yield text
+        return
+    executor = _get_pdf_executor()
+    futures = [executor.submit(extract_pdf_pages, file_path, start, stop) for start, stop in ranges]
+    for future in futures:
+        yield future.result()
+
+
+def _extract_pdf_text(file_path):
+    """Extract raw text from a PDF with pdfium (much faster than pdfminer-based pdfplumber)."""
+    buf = io.StringIO()
+    for text in iter_pdf_text(file_path, _pdf_page_ranges(file_path)):
+        buf.write(text)
+    return buf.getvalue().strip()
+
+
+class CachedPdf:
+    """
+    pdfplumber document wrapper that memoizes per-page text, so anything else
+    reading the same pages during a request doesn't re-run layout analysis.
+    """
+
+    def __init__(self, path):
+        self._pdf = pdfplumber.open(path)
+        self._text = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._pdf.pages)
+
+    def text(self, i):
+        if i not in self._text:
+            self._text[i] = self._pdf.pages[i].extract_text() or ""
+        return self._text[i]
+
+    def close(self):
+        self._pdf.close()
+
+
+def _extract_docx_text(file_path):
+    """
+    Stream word/document.xml once with iterparse, joining the text of each paragraph's
+    runs; run-level tabs and line breaks become tab/newline characters.
+    Paragraphs inside table cells are included. Text boxes are skipped: Word stores
+    each one twice (drawing and VML fallback), and they sit inside a run of the
+    surrounding paragraph. Each paragraph is freed after use.
+    """
+    buf = io.StringIO()
+    first = True
+    with zipfile.ZipFile(file_path) as z, z.open('word/document.xml') as f:
+        for _, para in etree.iterparse(f, events=('end',), tag=_W_P):
+            if next(para.iterancestors(_W_TXBX), None) is not None:
+                # Clearing it also keeps its runs out of the enclosing paragraph
+                para.clear()
+                continue
+            if not first:
+                buf.write('\n')
+            first = False
+            # Only run children: w:tab also appears as a tab-stop definition in w:pPr
+            for run in para.iter(_W_R):
+                for el in run:
+                    if el.tag == _W_T:
+                        if el.text:
+                            buf.write(el.text)
+                    elif el.tag == _W_TAB:
+                        buf.write('\t')
+                    elif el.tag == _W_CR or (el.tag == _W_BR and el.get(_W_TYPE, "textWrapping") == "textWrapping"):
+                        # page and column breaks carry no text, as in python-docx
+                        buf.write('\n')
+            para.clear()
+    return buf.getvalue().strip()
+
+
+def _file_digest(file_path):
+    """SHA-256 of the file's contents, read in 1 MiB blocks."""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _text_cache_get(key):
+    with _text_cache_lock:
+        value = _text_cache.get(key)
+        if value is not None:
+            _text_cache.move_to_end(key)
+        return value
+
+
+def _text_size(value):
+    """Characters held by a cached value: a text, or a tuple of per-range texts."""
+    return len(value) if isinstance(value, str) else sum(map(len, value))
+
+
+def _text_cache_set(key, value):
+    global _text_cache_chars
+    size = _text_size(value)
+    if size > TEXT_CACHE_MAX_CHARS:
+        return  # would evict everything else and still not fit
+    with _text_cache_lock:
+        old = _text_cache.pop(key, None)
+        if old is not None:
+            _text_cache_chars -= _text_size(old)
+        _text_cache[key] = value
+        _text_cache_chars += size
+        while len(_text_cache) > TEXT_CACHE_SIZE or _text_cache_chars > TEXT_CACHE_MAX_CHARS:
+            _, evicted = _text_cache.popitem(last=False)
+            _text_cache_chars -= _text_size(evicted)
+
+
+def extract_text_from_file(file_path, digest=None):
+    """
+    Extract text from an uploaded file. Results (including empty ones) are kept in
+    an in-process LRU keyed by content hash, so re-uploading the same document
+    skips the parsing. Pass digest if the caller has already hashed the file.
+    Plain text files are read directly: hashing them costs as much as reading them.
+    """
     ext = file_path.rsplit('.', 1)[1].lower()
+    if ext == 'txt':
+        return _extract_text_uncached(file_path, ext)
+    key = (digest or _file_digest(file_path), ext)
+    text = _text_cache_get(key)
+    if text is None:
+        text = _extract_text_uncached(file_path, ext)
+        if text is not None:
+            _text_cache_set(key, text)
+    return text
+
+
+def _extract_pdf_text_fallback(file_path):
+    """pdfplumber extraction, for PDFs where pdfium found no text layer."""
+    buf = io.StringIO()
+    with CachedPdf(file_path) as pdf:
+        for i in range(min(len(pdf), app.config['MAX_PDF_PAGES'])):
+            buf.write(pdf.text(i))
+    return buf.getvalue().strip()
+
+
+def _extract_text_uncached(file_path, ext):
     if ext == 'pdf':
-        with pdfplumber.open(file_path) as pdf:
-            text = ''.join([page.extract_text() or "" for page in pdf.pages])
-        return text.strip()
+        # Give pdfplumber a chance before giving up when pdfium finds no text layer
+        return _extract_pdf_text(file_path) or _extract_pdf_text_fallback(file_path)
     elif ext == 'docx':
-        doc = docx.Document(file_path)
-        text = '\n'.join([para.text for para in doc.paragraphs])
-        return text.strip()
+        return _extract_docx_text(file_path)
     elif ext == 'txt':
         with open(file_path, 'r', encoding="utf-8") as file:
             return file.read().strip()
     return None
 
 
+def _balanced_json_end(s, start):
+    """
+    Return the index just past the bracket that closes s[start], or -1 if it never closes.
+    Single pass, skipping brackets inside JSON strings.
+    """
+    open_ch = s[start]
+    close_ch = ']' if open_ch == '[' else '}'
+    depth = 0
+    in_str = False
+    esc = False
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == '\\':
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == open_ch:
+            depth += 1
+        elif c == close_ch:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+
+def _think_end(text):
+    """
+    Return the offset just past a leading <think>...</think> block, 0 if text doesn't
+    start with one, or -1 if it might (the block is unclosed, or too little text to tell).
+    """
+    head = text.lstrip()
+    if head.startswith("<think>"):
+        close = text.find("</think>")
+        return -1 if close == -1 else close + len("</think>")
+    if "<think>".startswith(head):
+        return -1
+    return 0
+
+
 def extract_json_substring(s):
     """
-    Find the first JSON array or object in string s and return it.
+    Find the MCQ JSON array (or failing that, the first JSON object) in string s and return it.
     This helps when model returns markdown or commentary around the JSON.
+    Applies the same rules as the streaming scan: a leading <think> block is skipped
+    and only an array whose first element is an object counts.
     """
-    # Try to find a top-level array first (MCQs are an array)
-    arr_match = re.search(r'(\[.*\])', s, flags=re.DOTALL)
-    if arr_match:
-        return arr_match.group(1)
-    # Otherwise try to find an object (fallback)
-    obj_match = re.search(r'(\{.*\})', s, flags=re.DOTALL)
-    if obj_match:
-        return obj_match.group(1)
+    start = _think_end(s)
+    if start == -1:
+        return None
+    stream = _StreamingJsonArray()
+    if stream.feed(s):
+        return stream.result()
+    # No array: fall back to the first balanced object after the reasoning
+    start = s.find('{', start)
+    if start != -1:
+        end = _balanced_json_end(s, start)
+        if end != -1:
+            return s[start:end]
     return None
 
 
+class _StreamingJsonArray:
+    """
+    Incrementally track streamed model output and detect when its top-level
+    JSON array is complete, skipping a leading <think>...</think> block.
+    Only an array whose first element is an object counts, so citation markers
+    like [1] or prose such as "[5] questions" are skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.start = None
+        self.end = None
+        self.depth = 0
+        self.in_str = False
+        self.esc = False
+        self.awaiting_first = False  # candidate '[' seen, first element not yet
+
+    def feed(self, chunk):
+        """Append a chunk; returns True once the array has been closed."""
+        self.text += chunk
+        if self.end is not None:
+            return True
+        if self.start is None and self.pos == 0:
+            skip = _think_end(self.text)
+            if skip == -1:
+                return False
+            self.pos = skip
+        text = self.text
+        for i in range(self.pos, len(text)):
+            c = text[i]
+            if self.start is None:
+                if c == '[':
+                    self.start = i
+                    self.depth = 1
+                    self.awaiting_first = True
+                continue
+            if self.awaiting_first:
+                if c.isspace():
+                    continue
+                self.awaiting_first = False
+                if c != '{':
+                    # Not the MCQ array; drop the candidate and keep scanning
+                    self.start = None
+                    self.depth = 0
+                    if c == '[':
+                        self.start = i
+                        self.depth = 1
+                        self.awaiting_first = True
+                    continue
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif c == '\\':
+                    self.esc = True
+                elif c == '"':
+                    self.in_str = False
+            elif c == '"':
+                self.in_str = True
+            elif c == '[':
+                self.depth += 1
+            elif c == ']':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = i + 1
+                    return True
+        self.pos = len(text)
+        return False
+
+    def result(self):
+        if self.end is not None:
+            return self.text[self.start:self.end]
+        return self.text.strip()
+
+
+def _drain_response(resp, limit=64 * 1024):
+    """
+    Read the rest of a streamed response (closing fence, citations, [DONE]) so
+    closing it returns the connection to the session pool instead of dropping it.
+    Gives up after `limit` bytes and lets the connection close.
+    """
+    read = 0
+    try:
+        for block in resp.iter_content(8192):
+            read += len(block)
+            if read > limit:
+                break
+    except requests.exceptions.RequestException:
+        pass
+
+
+def _choice_content(event, field):
+    """
+    Return choices[0][field]["content"] from a decoded completion or stream event,
+    or None if any part of it is missing or malformed.
+    Raises RuntimeError if the API sent an error payload instead.
+    """
+    if not isinstance(event, dict):
+        return None
+    if "error" in event:
+        error = event["error"]
+        if isinstance(error, dict):
+            error = error.get("message") or error
+        raise RuntimeError(f"API returned an error: {error}")
+    choices = event.get("choices")
+    if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+        return None
+    part = choices[0].get(field)
+    if not isinstance(part, dict):
+        return None
+    content = part.get("content")
+    return content if isinstance(content, str) else None
+
+
 def call_perplexity_json(prompt, timeout=20):
     """
     Call the Perplexity-like API and return text output (the assistant's content).
     This function only handles the HTTP call and returns raw text.
+    The response is streamed (SSE) and reading stops as soon as the MCQ array is
+    complete; timeout applies per read rather than to the whole generation.
     """
     url = "https://api.perplexity.ai/chat/completions"
     headers = {
@@ -70,47 +578,65 @@ def call_perplexity_json(prompt, timeout=20):
     }
 
     payload = {
-        "model": "sonar-reasoning-pro",
+        "model": MODEL,
         "messages": [
             {"role": "system", "content": "You are an MCQ generator that MUST return only valid JSON (no extra commentary)."},
             {"role": "user", "content": prompt}
         ],
-        "max_tokens": 2000
+        "max_tokens": 2000,
+        "stream": True
     }
 
+    stream = _StreamingJsonArray()
+    other_lines = []
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-        resp.raise_for_status()
-        data = resp.json()
-        # Defensive: ensure expected structure
-        content = data.get("choices", [{}])[0].get("message", {}).get("content")
-        if content is None:
-            # some APIs return different shapes; try other access patterns
-            # fallback: return raw text
-            return resp.text
-        return content.strip()
+        with _api_slots, _session.post(url, headers=headers, json=payload, timeout=timeout, stream=True) as resp:
+            resp.raise_for_status()
+            stopped_early = False
+            for line in resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    other_lines.append(line)
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    stopped_early = True
+                    break
+                try:
+                    event = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    continue
+                if stream.feed(_choice_content(event, "delta") or ""):
+                    stopped_early = True
+                    break
+            if stopped_early:
+                _drain_response(resp)
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"API request failed: {e}")
-    except ValueError:
-        # resp.json() failed
-        return resp.text
 
+    if stream.text:
+        return stream.result()
 
-def Question_mcqs_generator(input_text, num_questions, max_retries=1):
-    """
-    Returns a Python list of MCQs (each MCQ is dict with keys: question, options (dict A-D), correct)
-    On error, raises RuntimeError with a descriptive message.
-    """
-    # Build prompt requesting strict JSON
-    prompt = f"""
-Generate exactly {num_questions} multiple-choice questions (MCQs) based on the text provided below.
+    # Not an SSE response (e.g. streaming unsupported): parse it as a regular completion
+    body = b"\n".join(other_lines)
+    try:
+        content = _choice_content(orjson.loads(body), "message")
+    except orjson.JSONDecodeError:
+        content = None
+    if content is None:
+        # fallback: return raw text
+        return body.decode("utf-8", errors="replace")
+    return content.strip()
+
+
+_PROMPT_HEADER = """
+Generate exactly {n} multiple-choice questions (MCQs) based on the text provided below.
 
 **REQUIREMENTS (must follow exactly):**
 - Output only valid JSON (no surrounding text, no backticks, no commentary).
 - The top-level JSON MUST be an array of objects.
 - Each object must have:
   - "question": string
-  - "options": {"{"}"A":"string","B":"string","C":"string","D":"string"{"}"}  (all four keys present)
+  - "options": {{"A":"string","B":"string","C":"string","D":"string"}}  (all four keys present)
   - "correct": one of "A","B","C","D"
 - Example output format:
 [
@@ -123,32 +649,55 @@ Generate exactly {num_questions} multiple-choice questions (MCQs) based on the t
 ]
 
 Text to use for question generation:
-\"\"\"{input_text}
-\"\"\"
-    """.strip()
+""".lstrip()
+
+
+@lru_cache(maxsize=64)
+def _prompt_header(num_questions):
+    """Instruction part of the MCQ prompt; only num_questions varies, so it is built once per value."""
+    return _PROMPT_HEADER.format(n=num_questions)
+
+
+def _generate_chunk_mcqs(input_text, num_questions, max_retries=1):
+    """
+    Run a single prompt -> API -> parse -> validate cycle for one chunk of text.
+    Returns a validated list of MCQs or raises RuntimeError.
+    """
+    # Build prompt requesting strict JSON; the instructions are prebuilt per num_questions
+    prompt = _prompt_header(num_questions) + '"""' + input_text + '\n"""'
 
     last_error = None
     for attempt in range(max_retries + 1):
         try:
             raw = call_perplexity_json(prompt)
-            print("\n=== RAW MCQ TEXT FROM API ===\n")
-            print(raw)
-            print("\n=== END RAW MCQ TEXT ===\n")
-
-            # Try to parse directly first
-            try:
-                mcqs = json.loads(raw)
-                # validate structure
-                if not isinstance(mcqs, list):
-                    raise ValueError("Top-level JSON is not a list.")
-                validated = _validate_mcq_list(mcqs)
-                return validated
-            except json.JSONDecodeError:
+            # Only emitted when debug logging is on (e.g. app.run(debug=True))
+            app.logger.debug("RAW MCQ TEXT FROM API:\n%s", raw)
+
+            # Try to parse directly first, but only when the output looks like bare JSON;
+            # markdown-wrapped output goes straight to substring extraction
+            mcqs = None
+            stripped = raw.lstrip()
+            if stripped[:1] in ('[', '{'):
+                try:
+                    mcqs = orjson.loads(stripped)
+                except orjson.JSONDecodeError:
+                    pass
+
+            if mcqs is not None:
+                try:
+                    # validate structure
+                    if not isinstance(mcqs, list):
+                        raise ValueError("Top-level JSON is not a list.")
+                    validated = _validate_mcq_list(mcqs)
+                    return validated
+                except Exception as e:
+                    last_error = f"Validation failed: {e}"
+            else:
                 # Attempt to extract JSON substring and parse
                 candidate = extract_json_substring(raw)
                 if candidate:
                     try:
-                        mcqs = json.loads(candidate)
+                        mcqs = orjson.loads(candidate)
                         validated = _validate_mcq_list(mcqs)
                         return validated
                     except Exception as e:
@@ -156,15 +705,13 @@ Text to use for question generation:
                 else:
                     last_error = "No JSON found in API output."
 
-            except Exception as e:
-                last_error = f"Validation failed: {e}"
-
         except RuntimeError as e:
             last_error = str(e)
 
         # If we get here, retry (if attempts remain)
         if attempt < max_retries:
-            print(f"Retrying API call (attempt {attempt + 1}/{max_retries}) after short backoff...")
+            app.logger.warning("Retrying API call (attempt %d/%d) after short backoff: %s",
+                               attempt + 1, max_retries, last_error)
             time.sleep(1.5)
         else:
             break
@@ -173,10 +720,161 @@ Text to use for question generation:
     raise RuntimeError(f"Failed to generate valid MCQs. Last error: {last_error}")
 
 
+def _chunk_bounds(text, chunk_chars=CHUNK_CHARS):
+    """
+    Return (start, end) offsets splitting text into chunks of at most chunk_chars
+    characters, preferring paragraph (then line, then word) boundaries so
+    questions keep their context. Offsets only, so nothing is copied until a
+    chunk is actually used.
+    """
+    bounds = []
+    start = 0
+    n = len(text)
+    while start < n:
+        end = min(start + chunk_chars, n)
+        if end < n:
+            for sep in ("\n\n", "\n", " "):
+                cut = text.rfind(sep, start + chunk_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(sep)
+                    break
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def Question_mcqs_generator(input_text, num_questions, max_retries=1, max_chunks=MAX_PROMPT_CHUNKS):
+    """
+    Returns a Python list of MCQs (each MCQ is dict with keys: question, options (dict A-D), correct)
+    On error, raises RuntimeError with a descriptive message.
+    Results are cached per (model, text, num_questions), so repeat uploads skip the API.
+    Long texts are split into chunks whose API calls run concurrently; the
+    requested number of questions is spread across the chunks. At most
+    max_chunks chunks (MAX_PROMPT_CHUNKS by default), sampled evenly across the
+    text, are sent.
+    """
+    cache_key = LLMCache.make_key(MODEL, input_text, num_questions)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    bounds = _chunk_bounds(input_text)
+    limit = max(1, min(num_questions, max_chunks))
+    if len(bounds) > limit:
+        # Sample chunks evenly across the document instead of sending all of it
+        bounds = [bounds[i * len(bounds) // limit] for i in range(limit)]
+    chunks = [c for c in (input_text[start:end].strip() for start, end in bounds) if c]
+    chunks = chunks or [input_text.strip()]
+    base, extra = divmod(num_questions, len(chunks))
+    counts = [base + (1 if i < extra else 0) for i in range(len(chunks))]
+
+    if len(chunks) == 1:
+        mcqs = _generate_chunk_mcqs(chunks[0], counts[0], max_retries)
+    else:
+        futures = [
+            _api_executor.submit(_generate_chunk_mcqs, chunk, count, max_retries)
+            for chunk, count in zip(chunks, counts)
+        ]
+        mcqs = []
+        for future in futures:
+            mcqs.extend(future.result())
+        mcqs = _validate_mcq_list(mcqs)
+
+    llm_cache.set(cache_key, mcqs)
+    return mcqs
+
+
+def generate_mcqs_from_pdf(file_path, num_questions, max_retries=1, digest=None):
+    """
+    Generate MCQs from a PDF, starting the API calls for each page range as soon as
+    its text is extracted instead of waiting for the whole document. PDFs without
+    a pdfium text layer go through the pdfplumber fallback here, so the pdfium pass
+    is never repeated.
+    Returns None when no text could be extracted at all.
+    Pages are extracted in one range per core; the ranges are then grouped into at
+    most min(num_questions, MAX_PROMPT_CHUNKS) contiguous prompt units, and
+    MAX_PROMPT_CHUNKS is a budget for the whole document, split across the units.
+    """
+    # Per-range texts are cached by content hash, like extract_text_from_file; they
+    # don't depend on num_questions, and a hit doesn't even open the PDF
+    digest = digest or _file_digest(file_path)
+    cache_key = (digest, 'pdf-ranges')
+    cached_texts = _text_cache_get(cache_key)
+    if cached_texts is not None:
+        texts = cached_texts
+        n_ranges = len(cached_texts)
+    else:
+        ranges = _pdf_page_ranges(file_path)
+        texts = iter_pdf_text(file_path, ranges)
+        n_ranges = len(ranges)
+    if not n_ranges:
+        return None
+    extracted = []
+    n_units = max(1, min(n_ranges, num_questions, MAX_PROMPT_CHUNKS))
+    # Unit u covers ranges [unit_ends[u - 1], unit_ends[u])
+    unit_ends = [(u + 1) * n_ranges // n_units for u in range(n_units)]
+    base, extra = divmod(num_questions, n_units)
+    counts = [base + (1 if i < extra else 0) for i in range(n_units)]
+    base, extra = divmod(MAX_PROMPT_CHUNKS, n_units)
+    allowances = [base + (1 if i < extra else 0) for i in range(n_units)]
+
+    futures = []
+    parts = []  # range texts of the unit being assembled
+    unit = 0
+    carry = 0  # questions owed by units without any text
+    carry_chunks = 0  # and their unused chunk allowance
+    # The latest unit with text is held back until the next one arrives, so the
+    # share of any empty units after it can be folded into its own request
+    pending = None
+    with ThreadPoolExecutor(max_workers=n_units) as pipeline:
+        for i, text in enumerate(texts, 1):
+            extracted.append(text)
+            parts.append(text)
+            if i < unit_ends[unit]:
+                continue
+            text = ''.join(parts).strip()
+            parts = []
+            count, allowance = counts[unit], allowances[unit]
+            unit += 1
+            if not text:
+                carry += count
+                carry_chunks += allowance
+                continue
+            if pending is not None:
+                futures.append(pipeline.submit(Question_mcqs_generator, *pending))
+            pending = [text, count + carry, max_retries, allowance + carry_chunks]
+            carry = 0
+            carry_chunks = 0
+        if cached_texts is None:
+            _text_cache_set(cache_key, tuple(extracted))
+        if pending is None:
+            # No text layer: use pdfplumber, caching the outcome (even if empty)
+            # under the same key extract_text_from_file uses
+            text = _text_cache_get((digest, 'pdf'))
+            if text is None:
+                text = _extract_pdf_text_fallback(file_path)
+                _text_cache_set((digest, 'pdf'), text)
+            if not text:
+                return None
+            return Question_mcqs_generator(text, num_questions, max_retries)
+        pending[1] += carry
+        pending[3] += carry_chunks
+        futures.append(pipeline.submit(Question_mcqs_generator, *pending))
+
+        mcqs = []
+        for future in futures:
+            mcqs.extend(future.result())
+    return mcqs
+
+
+_OPTION_KEYS = ("A", "B", "C", "D")
+
+
 def _validate_mcq_list(mcqs):
     """
     Validate and normalize the list of MCQs returned by the API.
     Returns a clean list or raises ValueError on problems.
+    Each field is looked up and stripped exactly once.
     """
     if not isinstance(mcqs, list):
         raise ValueError("MCQs is not a list.")
@@ -185,32 +883,56 @@ def _validate_mcq_list(mcqs):
         if not isinstance(item, dict):
             raise ValueError(f"MCQ #{i} is not an object.")
         q = item.get("question")
-        opts = item.get("options")
-        corr = item.get("correct")
-
-        if not q or not isinstance(q, str):
+        if not isinstance(q, str) or not (q := q.strip()):
             raise ValueError(f"MCQ #{i} missing 'question' or it is not a string.")
+        opts = item.get("options")
         if not isinstance(opts, dict):
             raise ValueError(f"MCQ #{i} 'options' is missing or not an object.")
-        # Ensure all four options exist and are strings
-        for key in ["A", "B", "C", "D"]:
-            if key not in opts or not isinstance(opts[key], str) or not opts[key].strip():
+        # Ensure all four options exist and are non-empty strings
+        clean_opts = {}
+        for key in _OPTION_KEYS:
+            value = opts.get(key)
+            if not isinstance(value, str) or not (value := value.strip()):
                 raise ValueError(f"MCQ #{i} option '{key}' is missing or invalid.")
-        if corr not in ["A", "B", "C", "D"]:
+            clean_opts[key] = value
+        corr = item.get("correct")
+        if corr not in _OPTION_KEYS:
             raise ValueError(f"MCQ #{i} 'correct' must be one of A/B/C/D.")
-        clean.append({
-            "question": q.strip(),
-            "options": {k: opts[k].strip() for k in ["A", "B", "C", "D"]},
-            "correct": corr
-        })
+        clean.append({"question": q, "options": clean_opts, "correct": corr})
     return clean
 
 
+def _write_atomically(path, write):
+    """
+    Call write(tmp_path) on a unique temporary file next to path, then rename it into
+    place, so a file is never served half-written and concurrent exports with the
+    same name don't truncate each other's output.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp'
+    )
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def save_mcqs_to_file(mcqs, filename):
     results_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
     # Save as pretty JSON
-    with open(results_path, 'w', encoding="utf-8") as f:
-        json.dump(mcqs, f, ensure_ascii=False, indent=2)
+    data = orjson.dumps(mcqs, option=orjson.OPT_INDENT_2)
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+    _write_atomically(results_path, write)
     return results_path
 
 def safe_text(text: str) -> str:
@@ -241,6 +963,10 @@ def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
+# fpdf2 leaves the cursor to the right of a cell by default; fpdf 1.x wrapped to the next line
+_NEXT_LINE = {"new_x": XPos.LMARGIN, "new_y": YPos.NEXT}
+
+
 def create_pdf(mcqs, filename):
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -255,36 +981,25 @@ def create_pdf(mcqs, filename):
     # Header
     pdf.set_fill_color(*color_header)
     pdf.set_text_color(255, 255, 255)
-    pdf.set_font("Arial", "B", 18)
-    pdf.cell(0, 12, safe_text("Generated MCQs"), ln=True, align="C", fill=True)
+    pdf.set_font("Helvetica", "B", 18)
+    pdf.cell(0, 12, safe_text("Generated MCQs"), align="C", fill=True, **_NEXT_LINE)
     pdf.ln(8)
 
     for i, m in enumerate(mcqs, start=1):
         # ===== Question Header =====
         pdf.set_fill_color(*color_header)
         pdf.set_text_color(255, 255, 255)
-        pdf.set_font("Arial", "B", 12)
-
-        question_text = safe_text(f"{i}. {m['question']}")
-        # Estimate height for proper background sizing
-        start_x = pdf.get_x()
-        start_y = pdf.get_y()
-        pdf.multi_cell(0, 8, question_text, align="L")
-        end_y = pdf.get_y()
-
-        # Draw filled rectangle behind text
-        pdf.set_xy(start_x, start_y)
-        pdf.set_fill_color(*color_header)
-        pdf.set_text_color(255, 255, 255)
-        pdf.multi_cell(0, 8, question_text, align="L", fill=True)
+        pdf.set_font("Helvetica", "B", 12)
+        # multi_cell fills behind every wrapped line, so one layout pass is enough
+        pdf.multi_cell(0, 8, safe_text(f"{i}. {m['question']}"), align="L", fill=True, **_NEXT_LINE)
         pdf.ln(1)
 
         # ===== Options =====
         pdf.set_text_color(*color_black)
-        pdf.set_font("Arial", "", 11)
+        pdf.set_font("Helvetica", "", 11)
         for key in ["A", "B", "C", "D"]:
             opt_text = safe_text(f"{key}) {m['options'][key]}")
-            pdf.multi_cell(0, 7, opt_text)
+            pdf.multi_cell(0, 7, opt_text, **_NEXT_LINE)
             # Divider line
             pdf.set_draw_color(*color_divider)
             pdf.set_line_width(0.2)
@@ -296,22 +1011,61 @@ def create_pdf(mcqs, filename):
         # ===== Correct Answer =====
         pdf.set_fill_color(*color_correct)
         pdf.set_text_color(255, 255, 255)
-        pdf.set_font("Arial", "B", 11)
-        pdf.multi_cell(0, 7, safe_text(f"Correct Answer: {m['correct']}"), fill=True)
+        pdf.set_font("Helvetica", "B", 11)
+        pdf.multi_cell(0, 7, safe_text(f"Correct Answer: {m['correct']}"), fill=True, **_NEXT_LINE)
         pdf.ln(6)
 
     # ===== Footer =====
     pdf.ln(10)
-    pdf.set_font("Arial", "I", 9)
+    pdf.set_font("Helvetica", "I", 9)
     pdf.set_text_color(100, 100, 100)
-    pdf.multi_cell(0, 6, safe_text("Downloaded from MCQ Generator - All Rights Reserved 2025"), align="C")
+    pdf.multi_cell(0, 6, safe_text("Downloaded from MCQ Generator - All Rights Reserved 2025"), align="C", **_NEXT_LINE)
 
     # Save PDF
     pdf_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
-    pdf.output(pdf_path)
+    _write_atomically(pdf_path, pdf.output)
     return pdf_path
 
 
+def _submit_export(fn, mcqs, filename):
+    """
+    Run an export function in the background. Its pending marker is created before
+    returning, so a download request that arrives first (on any worker) sees the
+    export as in progress rather than missing.
+    """
+    fd, marker = tempfile.mkstemp(
+        dir=app.config['RESULTS_FOLDER'], prefix=filename + '.', suffix=PENDING_SUFFIX
+    )
+    os.close(fd)
+    future = _export_executor.submit(fn, mcqs, filename)
+
+    def _done(f):
+        if f.exception() is not None:
+            app.logger.error("Failed to write %s", filename, exc_info=f.exception())
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+    future.add_done_callback(_done)
+    return future
+
+
+def _export_pending(file_path):
+    """True if an export of file_path started less than EXPORT_TIMEOUT seconds ago is still running."""
+    now = time.time()
+    prefix = file_path + '.'
+    for marker in glob.glob(glob.escape(prefix) + '*' + PENDING_SUFFIX):
+        if '.' in marker[len(prefix):-len(PENDING_SUFFIX)]:
+            continue  # marker of a longer name that starts with this one
+        try:
+            if now - os.path.getmtime(marker) < EXPORT_TIMEOUT:
+                return True
+        except FileNotFoundError:
+            pass  # finished while we were looking
+    return False
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -331,11 +1085,6 @@ def generate_mcqs():
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     file.save(file_path)
 
-    text = extract_text_from_file(file_path)
-
-    if not text:
-        return "Failed to extract text from the uploaded file.", 400
-
     try:
         num_questions = int(request.form.get('num_questions', '0'))
         if num_questions <= 0:
@@ -343,35 +1092,50 @@ def generate_mcqs():
     except ValueError:
         return "Invalid number of questions.", 400
 
+    ext = filename.rsplit('.', 1)[1].lower()
+    # Hashed once for the text caches; .txt uploads don't use them
+    digest = _file_digest(file_path) if ext != 'txt' else None
     try:
-        mcqs = Question_mcqs_generator(text, num_questions, max_retries=1)
+        mcqs = None
+        if ext == 'pdf':
+            # Overlap page extraction with the API calls
+            mcqs = generate_mcqs_from_pdf(file_path, num_questions, max_retries=1, digest=digest)
+        if mcqs is None:
+            text = extract_text_from_file(file_path, digest=digest)
+            if not text:
+                return "Failed to extract text from the uploaded file.", 400
+            mcqs = Question_mcqs_generator(text, num_questions, max_retries=1)
     except RuntimeError as e:
         # Provide a useful error page instead of blank results
         err = str(e)
-        print("ERROR generating MCQs:", err)
+        app.logger.error("ERROR generating MCQs: %s", err)
         return render_template('error.html', error_message=err), 500
 
     # Save results
     txt_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.txt"
     pdf_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.pdf"
 
-    save_mcqs_to_file(mcqs, txt_filename)
-    create_pdf(mcqs, pdf_filename)
+    _submit_export(save_mcqs_to_file, mcqs, txt_filename)
+    _submit_export(create_pdf, mcqs, pdf_filename)
 
-    # Render results — mcqs is a list of dicts
-    return render_template('results.html', mcqs=mcqs, txt_filename=txt_filename, pdf_filename=pdf_filename)
+    # Render results — mcqs is a list of dicts; streamed so the page starts arriving immediately
+    return stream_template('results.html', mcqs=mcqs, txt_filename=txt_filename, pdf_filename=pdf_filename)
 
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    file_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
-    if not os.path.exists(file_path):
+    file_path = safe_join(app.config['RESULTS_FOLDER'], filename)
+    if file_path is None or not filename.endswith(('.txt', '.pdf')):
+        return "File not found", 404
+    if _export_pending(file_path):
+        # Still being written in the background; browsers reload via the Refresh header
+        return "File is still being generated, please try again in a moment.", 202, {"Retry-After": "1", "Refresh": "1"}
+    try:
+        return send_file(file_path, as_attachment=True)
+    except FileNotFoundError:
         return "File not found", 404
-    return send_file(file_path, as_attachment=True)
 
 
 if __name__ == "__main__":
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
     # Set debug=False in production
     app.run(debug=True)
@@ -0,0 +1,22 @@
+# pdf_worker.py: PDF text extraction run in worker processes.
+# Kept free of import-time side effects (no Flask app, cache or pools), so the
+# worker processes started by app.py only load pdfium, not the whole app.
+import io
+
+import pypdfium2 as pdfium
+
+
+def extract_pdf_pages(file_path, start, stop):
+    """Extract text for pages [start, stop) of a PDF. Opens its own handle, so it is safe to run in a worker process."""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        buf = io.StringIO()
+        for i in range(start, stop):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            buf.write(textpage.get_text_bounded())
+            textpage.close()
+            page.close()
+        return buf.getvalue()
+    finally:
+        pdf.close()